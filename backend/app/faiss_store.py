@@ -0,0 +1,168 @@
+"""
+FAISS Vector Store Module
+In-process HNSW index used instead of Chroma when VECTOR_BACKEND=faiss,
+optionally with 8-bit scalar-quantized storage (FAISS_QUANTIZATION=sq8).
+Implements the subset of the Chroma collection API that rag.py uses
+(get / add / query / count), so ingestion and retrieval code is shared.
+Vectors must be L2-normalized; inner product is then cosine similarity.
+"""
+import json
+import os
+import threading
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+# "flat" stores float32 vectors; "sq8" stores 8-bit scalar-quantized codes (4x less RAM)
+FAISS_QUANTIZATION = os.getenv("FAISS_QUANTIZATION", "flat").lower()
+
+_INDEX_FILE = "index.faiss"
+_DOCSTORE_FILE = "docstore.json"
+
+class FaissStore:
+    """HNSW index plus an in-memory docstore, optionally saved to a directory"""
+
+    def __init__(self, persist_directory: Optional[str] = None):
+        self.persist_directory = persist_directory
+        self.index = None
+        self.ids: List[str] = []
+        self.documents: List[str] = []
+        self.metadatas: List[Dict] = []
+        self._positions: Dict[str, int] = {}  # {chunk_id: row in the index}
+        self._by_filename: Dict[str, List[int]] = {}  # {filename: rows}, for filtered search
+        self._lock = threading.Lock()
+        if persist_directory and os.path.exists(os.path.join(persist_directory, _INDEX_FILE)):
+            self._load()
+
+    def _new_index(self, dim: int):
+        import faiss
+
+        if FAISS_QUANTIZATION == "sq8":
+            index = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_8bit, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            # Components of unit vectors lie in [-1, 1]; a fixed range needs no
+            # representative sample and never clips later uploads
+            index.train(np.vstack([-np.ones(dim), np.ones(dim)]).astype(np.float32))
+        else:
+            index = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+        return index
+
+    def _track(self, chunk_id: str, document: str, metadata: Optional[Dict]):
+        row = len(self.ids)
+        metadata = metadata or {}
+        self.ids.append(chunk_id)
+        self.documents.append(document)
+        self.metadatas.append(metadata)
+        self._positions[chunk_id] = row
+        self._by_filename.setdefault(metadata.get("filename"), []).append(row)
+
+    def count(self) -> int:
+        with self._lock:
+            return len(self.ids)
+
+    def get(self, ids: Optional[Sequence[str]] = None, include: Sequence[str] = ("metadatas", "documents")) -> Dict:
+        """Look up stored chunks by id (all chunks when ids is None)"""
+        with self._lock:
+            if ids is None:
+                rows = list(range(len(self.ids)))
+            else:
+                rows = [self._positions[i] for i in ids if i in self._positions]
+            result = {"ids": [self.ids[r] for r in rows]}
+            if "documents" in include:
+                result["documents"] = [self.documents[r] for r in rows]
+            if "metadatas" in include:
+                result["metadatas"] = [self.metadatas[r] for r in rows]
+            return result
+
+    def add(self, ids: List[str], embeddings: List[List[float]], documents: List[str], metadatas: List[Dict]):
+        """Add chunks; ids that are already stored are skipped"""
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        with self._lock:
+            new_rows = [i for i, chunk_id in enumerate(ids) if chunk_id not in self._positions]
+            if not new_rows:
+                return
+            if self.index is None:
+                self.index = self._new_index(vectors.shape[1])
+            self.index.add(np.ascontiguousarray(vectors[new_rows]))
+            for i in new_rows:
+                self._track(ids[i], documents[i], metadatas[i])
+
+    def query(
+        self,
+        query_embeddings: List[List[float]],
+        n_results: int,
+        where: Optional[Dict] = None,
+        include: Sequence[str] = ("documents", "metadatas", "distances")
+    ) -> Dict:
+        """Nearest neighbours of a single query, returned in Chroma's result shape"""
+        import faiss
+
+        result = {"ids": [[]], "documents": [[]], "metadatas": [[]], "distances": [[]], "embeddings": [[]]}
+        # HNSW inserts from ingestion threads must not run while the graph is searched
+        with self._lock:
+            if self.index is None or not self.ids:
+                return result
+
+            params = None
+            if where:
+                if set(where) == {"filename"}:
+                    allowed = self._by_filename.get(where["filename"], [])
+                else:
+                    allowed = [r for r, m in enumerate(self.metadatas) if all(m.get(k) == v for k, v in where.items())]
+                if not allowed:
+                    return result
+                # Restrict the graph search to matching rows instead of post-filtering
+                params = faiss.SearchParametersHNSW(
+                    sel=faiss.IDSelectorBatch(np.asarray(allowed, dtype=np.int64)),
+                    efSearch=max(HNSW_EF_SEARCH, n_results)
+                )
+
+            queries = np.asarray(query_embeddings, dtype=np.float32)
+            sims, rows = self.index.search(queries, min(n_results, len(self.ids)), params=params)
+            hits = [(float(s), int(r)) for s, r in zip(sims[0], rows[0]) if r >= 0]
+
+            result["ids"] = [[self.ids[r] for _, r in hits]]
+            result["documents"] = [[self.documents[r] for _, r in hits]]
+            result["metadatas"] = [[self.metadatas[r] for _, r in hits]]
+            # Report cosine distance, matching a Chroma collection in cosine space
+            result["distances"] = [[1.0 - s for s, _ in hits]]
+            if "embeddings" in include:
+                result["embeddings"] = [[self.index.reconstruct(r) for _, r in hits]]
+            return result
+
+    def relevance_score(self, distance: float) -> float:
+        """Convert a cosine distance back to a similarity score"""
+        return 1.0 - distance
+
+    def delete_collection(self):
+        """Drop all vectors and documents"""
+        with self._lock:
+            self.index = None
+            self.ids, self.documents, self.metadatas = [], [], []
+            self._positions, self._by_filename = {}, {}
+
+    def persist(self):
+        """Write the raw index and the docstore (no-op without a persist directory)"""
+        import faiss
+
+        if not self.persist_directory or self.index is None:
+            return
+        with self._lock:
+            os.makedirs(self.persist_directory, exist_ok=True)
+            faiss.write_index(self.index, os.path.join(self.persist_directory, _INDEX_FILE))
+            with open(os.path.join(self.persist_directory, _DOCSTORE_FILE), "w", encoding="utf-8") as f:
+                json.dump({"ids": self.ids, "documents": self.documents, "metadatas": self.metadatas}, f)
+
+    def _load(self):
+        import faiss
+
+        self.index = faiss.read_index(os.path.join(self.persist_directory, _INDEX_FILE))
+        self.index.hnsw.efSearch = HNSW_EF_SEARCH
+        with open(os.path.join(self.persist_directory, _DOCSTORE_FILE), encoding="utf-8") as f:
+            docstore = json.load(f)
+        for chunk_id, document, metadata in zip(docstore["ids"], docstore["documents"], docstore["metadatas"]):
+            self._track(chunk_id, document, metadata)
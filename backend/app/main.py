@@ -10,11 +10,15 @@ Features:
 from fastapi import FastAPI, UploadFile, File, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 import uvicorn
-import shutil
+import asyncio
+import aiofiles
 import os
+import json
+import uuid
+from concurrent.futures import ThreadPoolExecutor, Future
 from typing import List, Optional, Dict
 from dotenv import load_dotenv
 import time
@@ -23,12 +27,14 @@ import time
 load_dotenv()
 
 from .rag import (
+    warm_up,
     ingest_pdf, 
     get_answer, 
+    stream_answer,
     get_uploaded_files, 
     clear_knowledge_base,
     clear_conversation,
-    conversation_history
+    get_history
 )
 from .observability import (
     log_interaction, 
@@ -37,11 +43,13 @@ from .observability import (
     get_interaction_history,
     clear_metrics
 )
+from .shared_state import get_redis
 
 app = FastAPI(
     title="PDF RAG Chatbot",
     description="Chat with your PDFs - with conversation memory, citations, and observability",
-    version="2.0.0"
+    version="2.0.0",
+    default_response_class=ORJSONResponse  # Rust-backed serializer for large metrics payloads
 )
 
 # CORS Setup - Allow all origins for development
@@ -62,6 +70,69 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def warmup():
+    """Load the embedding model and connect to Redis and the LLM before serving traffic"""
+    await asyncio.to_thread(get_redis)  # Logs (and later retries) when REDIS_URL is set but unreachable
+    try:
+        await asyncio.to_thread(warm_up)
+    except Exception as e:
+        # Not fatal - everything is loaded lazily on first use anyway
+        print(f"Warmup failed: {e}")
+
+# ============== BACKGROUND INGESTION ==============
+# Ingestion runs in a thread pool (not a process pool) because ingest_pdf
+# updates the shared vector store and file registry in this process.
+MAX_PDF_MB = int(os.getenv("MAX_PDF_MB", "50"))
+MAX_PDF_BYTES = MAX_PDF_MB * 1024 * 1024
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+ingest_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
+JOB_TTL_SECONDS = 3600  # Finished jobs stay pollable this long
+MAX_TRACKED_JOBS = 1000  # Beyond this, the oldest finished jobs are dropped early
+jobs: Dict[str, Dict] = {}  # Track ingestion jobs {job_id: job_info}
+_REDIS_JOB_PREFIX = "upload:job:"  # Per-job JSON, so any worker can answer status polls
+
+def _evict_finished_jobs():
+    """Forget finished jobs past their TTL, and the oldest ones above MAX_TRACKED_JOBS"""
+    now = time.time()
+    finished = sorted(
+        (job["finished_at"], job_id) for job_id, job in list(jobs.items()) if "finished_at" in job
+    )
+    overflow = len(jobs) - MAX_TRACKED_JOBS
+    for i, (finished_at, job_id) in enumerate(finished):
+        if i >= overflow and now - finished_at < JOB_TTL_SECONDS:
+            break
+        jobs.pop(job_id, None)
+
+def _publish_job(job: Dict):
+    """Mirror a job's current state to Redis (expires with the local entry)"""
+    r = get_redis()
+    if r is not None:
+        r.set(_REDIS_JOB_PREFIX + job["job_id"], json.dumps(job), ex=JOB_TTL_SECONDS)
+
+def _on_ingest_done(job_id: str, future: Future):
+    """Record the outcome of a finished ingestion job"""
+    job = jobs[job_id]
+    job["finished_at"] = time.time()
+    try:
+        job["chunks"] = future.result()
+        job["total_files"] = len(get_uploaded_files())
+        job["status"] = "completed"
+    except Exception as e:
+        job["status"] = "failed"
+        job["error"] = str(e)
+        log_error("upload_error", str(e), {"filename": job["filename"]})
+    _publish_job(job)
+
+def _run_ingest_job(job_id: str, file_path: str) -> int:
+    """Worker entry point: mark the job running, ingest, then delete the upload"""
+    jobs[job_id]["status"] = "processing"
+    _publish_job(jobs[job_id])
+    try:
+        return ingest_pdf(file_path, filename=os.path.basename(jobs[job_id]["filename"]))
+    finally:
+        os.remove(file_path)
+
 # ============== REQUEST/RESPONSE MODELS ==============
 
 class ChatRequest(BaseModel):
@@ -76,10 +147,17 @@ class ChatResponse(BaseModel):
     metadata: Dict
 
 class UploadResponse(BaseModel):
+    job_id: str
     filename: str
     status: str
-    chunks: int
-    total_files: int
+
+class UploadStatusResponse(BaseModel):
+    job_id: str
+    filename: str
+    status: str
+    chunks: Optional[int] = None
+    total_files: Optional[int] = None
+    error: Optional[str] = None
 
 # ============== ENDPOINTS ==============
 
@@ -102,44 +180,78 @@ async def root():
 @app.post("/upload", response_model=UploadResponse)
 async def upload_pdf(file: UploadFile = File(...)):
     """
-    Upload and process a PDF file.
+    Upload a PDF file and queue it for processing.
     Supports multiple files - each upload adds to the knowledge base.
+    Returns a job id; poll GET /upload/{job_id} for the result.
     """
     try:
         # Validate file type
         if not file.filename.lower().endswith('.pdf'):
             raise HTTPException(status_code=400, detail="Only PDF files are allowed")
         
-        # Save temp file
+        # Reject oversize files up front when the client declared a size
+        if file.size is not None and file.size > MAX_PDF_BYTES:
+            raise HTTPException(status_code=413, detail=f"PDF exceeds the {MAX_PDF_MB} MB upload limit")
+        
+        # Save temp file under the job id, so uploads sharing a filename can't overwrite each other
+        job_id = uuid.uuid4().hex
         temp_dir = "temp_pdfs"
         os.makedirs(temp_dir, exist_ok=True)
-        file_path = os.path.join(temp_dir, file.filename)
+        file_path = os.path.join(temp_dir, f"{job_id}.pdf")
         
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        # Stream to disk in chunks so the event loop stays free
+        bytes_written = 0
+        async with aiofiles.open(file_path, "wb") as buffer:
+            while chunk := await file.read(1024 * 1024):
+                bytes_written += len(chunk)
+                if bytes_written > MAX_PDF_BYTES:
+                    break
+                await buffer.write(chunk)
         
-        # Ingest PDF
-        num_chunks = ingest_pdf(file_path)
+        # The size wasn't declared (or was wrong) - stop as soon as the limit is crossed
+        if bytes_written > MAX_PDF_BYTES:
+            os.remove(file_path)
+            raise HTTPException(status_code=413, detail=f"PDF exceeds the {MAX_PDF_MB} MB upload limit")
         
-        # Get total files count
-        uploaded = get_uploaded_files()
+        # Queue ingestion in the worker pool (parsing + embedding are blocking)
+        _evict_finished_jobs()
+        jobs[job_id] = {
+            "job_id": job_id,
+            "filename": file.filename,
+            "status": "queued",
+            "created_at": time.time()
+        }
+        _publish_job(jobs[job_id])
+        future = ingest_executor.submit(_run_ingest_job, job_id, file_path)
+        future.add_done_callback(lambda f: _on_ingest_done(job_id, f))
         
         return UploadResponse(
+            job_id=job_id,
             filename=file.filename,
-            status="Uploaded and processed successfully",
-            chunks=num_chunks,
-            total_files=len(uploaded)
+            status="queued"
         )
         
-    except ValueError as ve:
-        log_error("upload_error", str(ve), {"filename": file.filename})
-        raise HTTPException(status_code=400, detail=str(ve))
+    except HTTPException:
+        raise
     except Exception as e:
         log_error("upload_error", str(e), {"filename": file.filename})
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/upload/{job_id}", response_model=UploadStatusResponse)
+async def get_upload_status(job_id: str):
+    """Poll the status of a queued PDF ingestion job"""
+    job = jobs.get(job_id)
+    if job is None:
+        # The job may have been queued by another worker
+        r = get_redis()
+        cached = r.get(_REDIS_JOB_PREFIX + job_id) if r is not None else None
+        job = json.loads(cached) if cached else None
+    if job is None:
+        raise HTTPException(status_code=404, detail="Upload job not found")
+    return UploadStatusResponse(**job)
+
 @app.post("/chat", response_model=ChatResponse)
 async def chat(request: ChatRequest):
     """
@@ -186,6 +298,43 @@ async def chat(request: ChatRequest):
         log_error("chat_error", str(e), {"question": request.question[:100]})
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """
+    Chat with the uploaded documents, streaming the answer as Server-Sent Events.
+    Emits {"token": ...} events while generating, then a final event with
+    the full answer, citations and metadata (same fields as /chat).
+    """
+    def event_stream():
+        start_time = time.time()
+        try:
+            for event in stream_answer(
+                question=request.question,
+                filter_filename=request.filter_filename,
+                use_history=request.use_history
+            ):
+                if event.get("done"):
+                    metadata = event["metadata"]
+                    log_interaction(
+                        session_id=request.session_id,
+                        question=request.question,
+                        answer=event["answer"],
+                        latency=time.time() - start_time,
+                        tokens_input=metadata.get("tokens_input", 0),
+                        tokens_output=metadata.get("tokens_output", 0),
+                        confidence=metadata.get("confidence", 0),
+                        model=metadata.get("model", "unknown"),
+                        was_refused=metadata.get("refused", False),
+                        filter_used=request.filter_filename
+                    )
+                yield f"data: {json.dumps(event)}\n\n"
+        except Exception as e:
+            log_error("chat_error", str(e), {"question": request.question[:100]})
+            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+    
+    # A sync generator is iterated in the threadpool, keeping blocking LLM I/O off the event loop
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
 @app.get("/files")
 async def list_files():
     """List all uploaded files with chunk counts"""
@@ -213,9 +362,10 @@ async def clear_chat_history():
 @app.get("/conversation")
 async def get_chat_history():
     """Get current conversation history"""
+    history = get_history()
     return {
-        "history": conversation_history,
-        "message_count": len(conversation_history)
+        "history": history,
+        "message_count": len(history)
     }
 
 @app.get("/metrics")
@@ -231,7 +381,7 @@ async def get_metrics():
     return get_metrics_summary()
 
 @app.get("/metrics/history")
-async def get_history(
+async def get_metrics_history(
     session_id: Optional[str] = Query(None, description="Filter by session"),
     limit: int = Query(50, description="Max results")
 ):
@@ -273,4 +423,7 @@ else:
     print("Run 'npm run build' in the frontend folder to create the build")
 
 if __name__ == "__main__":
-    uvicorn.run("app.main:app", host="0.0.0.0", port=8000, reload=True)
+    # Extra workers only share chat history, metrics and upload job status when
+    # REDIS_URL is set; the vector store is still per process
+    workers = int(os.getenv("UVICORN_WORKERS", "1"))
+    uvicorn.run("app.main:app", host="0.0.0.0", port=8000, reload=workers == 1, workers=workers)
@@ -3,15 +3,50 @@ Enhanced Observability Module
 Tracks: queries, latency, tokens, errors, and more
 """
 import os
+from collections import deque
 from datetime import datetime
-from typing import Dict, List, Optional
+from itertools import islice
+from typing import Deque, Dict, List, Optional
 import json
 
-# In-memory storage for metrics (use Redis/DB in production)
-interactions_log: List[Dict] = []
-error_log: List[Dict] = []
+import numpy as np
+
+from .shared_state import get_redis
+
+# In-memory storage for metrics (mirrored to Redis when REDIS_URL is set)
+# Bounded deques evict the oldest entry in O(1) once full
+interactions_log: Deque[Dict] = deque(maxlen=1000)  # Last 1000 interactions
+error_log: Deque[Dict] = deque(maxlen=100)  # Last 100 errors
 daily_stats: Dict[str, Dict] = {}
 
+# Numeric columns of interactions_log as a ring buffer, so summaries are vectorized
+# Columns: latency_ms, tokens_total, confidence, was_refused
+_metrics_array = np.zeros((interactions_log.maxlen, 4), dtype=np.float64)
+_metrics_next = 0  # Total rows written; the next write goes to _metrics_next % maxlen
+
+# Redis keys for metrics shared across workers
+_REDIS_INTERACTIONS = "metrics:interactions"  # LIST, newest first
+_REDIS_ERRORS = "metrics:errors"  # LIST, newest first
+_REDIS_DAILY_DATES = "metrics:daily_dates"  # ZSET of date keys (lexicographic)
+_REDIS_DAILY_PREFIX = "metrics:daily:"  # HASH per date
+
+def _summarize_metrics(metrics: np.ndarray) -> Dict:
+    """Aggregate an (n, 4) metrics array in one vectorized pass"""
+    total_queries = len(metrics)
+    means = metrics.mean(axis=0)
+    p50_latency, p95_latency = np.percentile(metrics[:, 0], [50, 95])
+    total_tokens = int(metrics[:, 1].sum())
+    return {
+        "total_queries": total_queries,
+        "average_latency_ms": round(float(means[0]), 2),
+        "p50_latency_ms": int(p50_latency),
+        "p95_latency_ms": int(p95_latency),
+        "total_tokens": total_tokens,
+        "avg_tokens_per_query": round(total_tokens / total_queries, 2),
+        "average_confidence": round(float(means[2]), 3),
+        "refused_rate": round(float(means[3]) * 100, 1)
+    }
+
 def log_interaction(
     session_id: str,
     question: str,
@@ -43,7 +78,15 @@ def log_interaction(
         "filter_used": filter_used
     }
     
+    global _metrics_next
     interactions_log.append(interaction)
+    _metrics_array[_metrics_next % interactions_log.maxlen] = (
+        interaction["latency_ms"],
+        interaction["tokens_total"],
+        interaction["confidence"],
+        1.0 if was_refused else 0.0
+    )
+    _metrics_next += 1
     
     # Update daily stats
     if date_key not in daily_stats:
@@ -61,9 +104,19 @@ def log_interaction(
     if was_refused:
         daily_stats[date_key]["refused_count"] += 1
     
-    # Keep only last 1000 interactions in memory
-    if len(interactions_log) > 1000:
-        interactions_log.pop(0)
+    r = get_redis()
+    if r is not None:
+        daily_key = _REDIS_DAILY_PREFIX + date_key
+        pipe = r.pipeline()
+        pipe.lpush(_REDIS_INTERACTIONS, json.dumps(interaction))
+        pipe.ltrim(_REDIS_INTERACTIONS, 0, interactions_log.maxlen - 1)
+        pipe.zadd(_REDIS_DAILY_DATES, {date_key: 0})
+        pipe.hincrby(daily_key, "total_queries", 1)
+        pipe.hincrby(daily_key, "total_tokens", tokens_input + tokens_output)
+        pipe.hincrby(daily_key, "total_latency_ms", interaction["latency_ms"])
+        pipe.hincrby(daily_key, "refused_count", 1 if was_refused else 0)
+        pipe.hincrby(daily_key, "error_count", 0)
+        pipe.execute()
 
 def log_error(
     error_type: str,
@@ -87,12 +140,57 @@ def log_error(
     if date_key in daily_stats:
         daily_stats[date_key]["error_count"] += 1
     
-    # Keep only last 100 errors
-    if len(error_log) > 100:
-        error_log.pop(0)
+    r = get_redis()
+    if r is not None:
+        pipe = r.pipeline()
+        pipe.lpush(_REDIS_ERRORS, json.dumps(error, default=str))
+        pipe.ltrim(_REDIS_ERRORS, 0, error_log.maxlen - 1)
+        pipe.execute()
+        if r.zscore(_REDIS_DAILY_DATES, date_key) is not None:
+            r.hincrby(_REDIS_DAILY_PREFIX + date_key, "error_count", 1)
+
+def _shared_metrics_summary(r) -> Dict:
+    """Summary computed from the Redis-backed logs, so every worker reports the same numbers"""
+    interactions = [json.loads(i) for i in r.lrange(_REDIS_INTERACTIONS, 0, -1)]  # Newest first
+    error_count = r.llen(_REDIS_ERRORS)
+    dates = r.zrange(_REDIS_DAILY_DATES, -7, -1)
+    pipe = r.pipeline()
+    for date_key in dates:
+        pipe.hgetall(_REDIS_DAILY_PREFIX + date_key)
+    daily = {
+        date_key: {k: int(v) for k, v in stats.items()}
+        for date_key, stats in zip(dates, pipe.execute())
+    }
+    
+    if not interactions:
+        return {
+            "total_queries": 0,
+            "average_latency_ms": 0,
+            "total_tokens": 0,
+            "recent_interactions": [],
+            "daily_stats": daily,
+            "error_count": error_count
+        }
+    
+    metrics = np.array(
+        [(i["latency_ms"], i["tokens_total"], i["confidence"], i.get("was_refused", False)) for i in interactions],
+        dtype=np.float64
+    )
+    
+    return {
+        **_summarize_metrics(metrics),
+        "error_count": error_count,
+        "recent_interactions": interactions[:10],
+        "recent_errors": [json.loads(e) for e in r.lrange(_REDIS_ERRORS, 0, 4)],
+        "daily_stats": daily
+    }
 
 def get_metrics_summary() -> Dict:
     """Get comprehensive metrics summary"""
+    r = get_redis()
+    if r is not None:
+        return _shared_metrics_summary(r)
+    
     if not interactions_log:
         return {
             "total_queries": 0,
@@ -103,30 +201,14 @@ def get_metrics_summary() -> Dict:
             "error_count": len(error_log)
         }
     
-    # Calculate averages
-    total_queries = len(interactions_log)
-    avg_latency = sum(i["latency_ms"] for i in interactions_log) / total_queries
-    total_tokens = sum(i["tokens_total"] for i in interactions_log)
-    avg_confidence = sum(i["confidence"] for i in interactions_log) / total_queries
-    refused_count = sum(1 for i in interactions_log if i.get("was_refused", False))
-    
-    # Latency percentiles
-    latencies = sorted([i["latency_ms"] for i in interactions_log])
-    p50_idx = len(latencies) // 2
-    p95_idx = int(len(latencies) * 0.95)
+    # Ring-buffer rows are unordered, which doesn't matter for means/percentiles
+    summary = _summarize_metrics(_metrics_array[:len(interactions_log)])
     
     return {
-        "total_queries": total_queries,
-        "average_latency_ms": round(avg_latency, 2),
-        "p50_latency_ms": latencies[p50_idx] if latencies else 0,
-        "p95_latency_ms": latencies[p95_idx] if len(latencies) > 1 else latencies[-1] if latencies else 0,
-        "total_tokens": total_tokens,
-        "avg_tokens_per_query": round(total_tokens / total_queries, 2) if total_queries else 0,
-        "average_confidence": round(avg_confidence, 3),
-        "refused_rate": round(refused_count / total_queries * 100, 1) if total_queries else 0,
+        **summary,
         "error_count": len(error_log),
-        "recent_interactions": interactions_log[-10:][::-1],  # Last 10, newest first
-        "recent_errors": error_log[-5:][::-1],  # Last 5 errors
+        "recent_interactions": list(islice(reversed(interactions_log), 10)),  # Last 10, newest first
+        "recent_errors": list(islice(reversed(error_log), 5)),  # Last 5 errors
         "daily_stats": dict(list(daily_stats.items())[-7:])  # Last 7 days
     }
 
@@ -135,15 +217,25 @@ def get_interaction_history(
     limit: int = 50
 ) -> List[Dict]:
     """Get interaction history, optionally filtered by session"""
+    r = get_redis()
+    if r is not None:
+        newest_first = (json.loads(i) for i in r.lrange(_REDIS_INTERACTIONS, 0, -1))
+    else:
+        newest_first = reversed(interactions_log)
     if session_id:
-        filtered = [i for i in interactions_log if i["session_id"] == session_id]
-        return filtered[-limit:][::-1]
-    return interactions_log[-limit:][::-1]
+        newest_first = (i for i in newest_first if i["session_id"] == session_id)
+    return list(islice(newest_first, limit))
 
 def clear_metrics():
     """Clear all metrics (for testing)"""
-    global interactions_log, error_log, daily_stats
-    interactions_log = []
-    error_log = []
-    daily_stats = {}
+    global _metrics_next
+    interactions_log.clear()
+    error_log.clear()
+    daily_stats.clear()
+    _metrics_next = 0
+    
+    r = get_redis()
+    if r is not None:
+        daily_keys = [_REDIS_DAILY_PREFIX + d for d in r.zrange(_REDIS_DAILY_DATES, 0, -1)]
+        r.delete(_REDIS_INTERACTIONS, _REDIS_ERRORS, _REDIS_DAILY_DATES, *daily_keys)
     return True
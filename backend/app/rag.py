@@ -1,26 +1,94 @@
 import os
+import re
 import time
-from typing import List, Tuple, Dict, Optional
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from typing import Deque, Iterator, List, Tuple, Dict, Optional
 from datetime import datetime
+import numpy as np
 import fitz  # PyMuPDF - better PDF handling
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import Chroma
-from langchain_community.embeddings import HuggingFaceEmbeddings
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
 from langchain_core.documents import Document
-import tiktoken
+from langchain_core.embeddings import Embeddings
+from langchain_core.prompts import ChatPromptTemplate
+import json
+
+from .faiss_store import FaissStore
+from .shared_state import get_redis
+from .tokenizer_cache import count_tokens as _cached_count_tokens, token_length
 
 # ============== GLOBAL STATE ==============
 vector_store = None
 retriever = None
 llm = None
-conversation_history: List[Dict] = []  # Conversation memory
 uploaded_documents: Dict[str, int] = {}  # Track uploaded files {filename: chunk_count}
+_ingest_lock = threading.Lock()  # Serializes vector store writes from ingestion workers
+_cache_revision = 0  # Bumped whenever cached answers may be stale
+_kb_generation = 0  # Bumped (under _ingest_lock) when the knowledge base is cleared
 
 # ============== CONFIGURATION ==============
 CONFIDENCE_THRESHOLD = 0.0  # Disabled - always try to answer (was 0.3)
-MAX_CONVERSATION_HISTORY = 10  # Keep last N messages
-CHUNK_SIZE = 1000
-CHUNK_OVERLAP = 100
+MAX_CONVERSATION_HISTORY = 10  # Keep last N exchanges
+MAX_HISTORY_CONTEXT_TOKENS = 500  # Budget for history in the LLM prompt (~4 chars per token)
+# Chunk sizes are in tokens; all-MiniLM-L6-v2 truncates input beyond 256 word pieces
+CHUNK_SIZE = 200
+CHUNK_OVERLAP = 30
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", min(8, os.cpu_count() or 1)))  # Threads for page text extraction
+PDF_PARALLEL_MIN_PAGES = 16  # Below this, thread startup costs more than it saves
+PDF_PAGES_PER_RANGE = 16  # Pages extracted per task; with the in-flight window this bounds text held in memory
+# Plain text extraction without reading-order sort; ligatures are expanded (better for search)
+PDF_TEXT_FLAGS = fitz.TEXT_PRESERVE_WHITESPACE | fitz.TEXT_MEDIABOX_CLIP
+INGEST_BATCH_SIZE = 1000  # Chunks embedded together in one bulk encode
+CHROMA_ADD_BATCH_SIZE = 200  # Chunks per collection.add call (Chroma's sweet spot is 100-250)
+RETRIEVAL_K = 4  # Chunks passed to the LLM
+RETRIEVAL_FETCH_K = 20  # Candidates considered by MMR
+MMR_LAMBDA = 0.5  # 1 = pure relevance, 0 = pure diversity
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma").lower()  # "chroma" or "faiss"
+CHROMA_PERSIST = os.getenv("CHROMA_PERSIST", "false").lower() in ("1", "true", "yes")
+CHROMA_PERSIST_DIRECTORY = "./chroma_db"
+FAISS_PERSIST = os.getenv("FAISS_PERSIST", "false").lower() in ("1", "true", "yes")
+FAISS_PERSIST_DIRECTORY = "./faiss_db"
+CHROMA_COLLECTION_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 32,
+    "hnsw:construction_ef": 200,
+    "hnsw:search_ef": 64,
+    # Buffer inserts and persist the index in large batches (not per add)
+    "hnsw:batch_size": 1000,
+    "hnsw:sync_threshold": 10000
+}
+EXACT_CACHE_SIZE = 512  # Max memoized exact-match questions
+SEMANTIC_CACHE_SIZE = 256  # Max cached answers
+SEMANTIC_CACHE_THRESHOLD = 0.92  # Cosine similarity needed for a cache hit
+SEMANTIC_CACHE_TTL = 3600  # Seconds before a cached answer expires
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+EMBEDDING_BATCH_SIZE = 128
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", 2))  # Concurrent encode calls per ingestion batch
+EMBEDDING_ONNX_DIR = os.getenv("EMBEDDING_ONNX_DIR")  # Optional int8 ONNX export of the model
+
+# Ordered most-stable first: instructions, then document context, then the
+# per-turn parts. Ollama reuses the KV cache for a prompt prefix it has already
+# processed, so keeping volatile text at the end maximizes that reuse.
+PROMPT_TEMPLATE = """You are a helpful assistant answering questions about documents.
+Based ONLY on the following context from the documents, answer the question.
+Be concise and specific. Give a direct answer in 1-3 sentences.
+If the answer is not in the context, say "I cannot find this specific information in the uploaded documents."
+
+Context from documents:
+{context}
+
+{conversation_context}
+
+Question: {question}
+
+Answer:"""
+_PROMPT = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)  # Built once, reused for every question
 
 # ============== GREETING/CASUAL CHAT DETECTION ==============
 GREETING_PATTERNS = [
@@ -33,17 +101,16 @@ CASUAL_PATTERNS = [
     "help", "thank you", "thanks", "bye", "goodbye", "see you"
 ]
 
+# Compiled once: a greeting is the whole message or followed by " ", "!" or ","
+_GREETING_RE = re.compile(r"^(?:" + "|".join(re.escape(p) for p in GREETING_PATTERNS) + r")(?:$|[ !,])")
+_CASUAL_RE = re.compile("|".join(re.escape(p) for p in CASUAL_PATTERNS))
+
 def is_greeting_or_casual(text: str) -> bool:
     """Check if the message is a greeting or casual conversation"""
     text_lower = text.lower().strip()
-    # Check for greetings
-    for pattern in GREETING_PATTERNS:
-        if text_lower == pattern or text_lower.startswith(pattern + " ") or text_lower.startswith(pattern + "!") or text_lower.startswith(pattern + ","):
-            return True
-    # Check for casual patterns
-    for pattern in CASUAL_PATTERNS:
-        if pattern in text_lower:
-            return True
+    # Check for greetings and casual patterns
+    if _GREETING_RE.match(text_lower) or _CASUAL_RE.search(text_lower):
+        return True
     # Very short messages are likely casual
     if len(text_lower.split()) <= 2 and not any(c.isdigit() for c in text_lower):
         return True
@@ -86,155 +153,530 @@ Upload a PDF to get started!"""
 
 # ============== TOKEN COUNTING ==============
 def count_tokens(text: str, model: str = "gpt-3.5-turbo") -> int:
-    """Count tokens using tiktoken"""
+    """Count tokens using tiktoken (encoder loaded once per model, counts cached per text)"""
     try:
-        encoding = tiktoken.encoding_for_model(model)
-        return len(encoding.encode(text))
+        return _cached_count_tokens(text, model)
     except:
         # Fallback: rough estimate
         return len(text) // 4
 
 # ============== CONVERSATION MEMORY ==============
+# Conversation memory: bounded, so appends drop the oldest message in O(1)
+conversation_history: Deque[Dict] = deque(maxlen=MAX_CONVERSATION_HISTORY * 2)
+_history_revision = 0  # Bumped on every history change
+_rendered_history: Tuple[int, str] = (-1, "")  # (revision, rendered context)
+# LIST shared by all workers when Redis is enabled. Like the in-memory deque it is a
+# single conversation: get_answer and the /conversation endpoints take no session id
+_REDIS_HISTORY = "conversation:history"
+
 def add_to_history(role: str, content: str):
-    """Add message to conversation history"""
-    global conversation_history
-    conversation_history.append({
+    """Add message to conversation history (the oldest are dropped past the limit)"""
+    global _history_revision
+    message = {
         "role": role,
         "content": content,
         "timestamp": datetime.now().isoformat()
-    })
-    # Keep only last N messages
-    if len(conversation_history) > MAX_CONVERSATION_HISTORY * 2:
-        conversation_history = conversation_history[-MAX_CONVERSATION_HISTORY * 2:]
+    }
+    r = get_redis()
+    if r is not None:
+        pipe = r.pipeline()
+        pipe.rpush(_REDIS_HISTORY, json.dumps(message))
+        pipe.ltrim(_REDIS_HISTORY, -conversation_history.maxlen, -1)
+        pipe.execute()
+    else:
+        conversation_history.append(message)
+    _history_revision += 1
+
+def get_history(last: Optional[int] = None) -> List[Dict]:
+    """Get conversation messages, oldest first (optionally only the last N)"""
+    r = get_redis()
+    if r is not None:
+        start = -last if last else 0
+        return [json.loads(m) for m in r.lrange(_REDIS_HISTORY, start, -1)]
+    start = max(0, len(conversation_history) - last) if last else 0
+    return list(islice(conversation_history, start, None))
 
 def get_conversation_context() -> str:
-    """Get formatted conversation history for context"""
-    if not conversation_history:
+    """Get formatted conversation history for context, bounded by MAX_HISTORY_CONTEXT_TOKENS"""
+    global _rendered_history
+    shared = get_redis() is not None
+    # Another worker may have changed the shared history, so only memoize local history
+    if not shared and _rendered_history[0] == _history_revision:
+        return _rendered_history[1]
+    
+    messages = get_history()  # Whole bounded history; the token budget decides how much fits
+    if not messages:
         return ""
     
-    context = "Previous conversation:\n"
-    for msg in conversation_history[-6:]:  # Last 3 exchanges
+    # Walk back from the newest message until the token budget is spent
+    lines = []
+    budget = MAX_HISTORY_CONTEXT_TOKENS
+    for msg in reversed(messages):
         role = "User" if msg["role"] == "user" else "Assistant"
-        context += f"{role}: {msg['content'][:200]}\n"
+        line = f"{role}: {msg['content'][:200]}"
+        budget -= (len(line) + 1) // 4
+        if budget < 0:
+            break
+        lines.append(line)
+    
+    # Single join over the collected lines (no repeated string concatenation)
+    context = "\n".join(["Previous conversation:", *reversed(lines)]) + "\n"
+    if not shared:
+        _rendered_history = (_history_revision, context)
     return context
 
 def clear_conversation():
     """Clear conversation history"""
-    global conversation_history
-    conversation_history = []
+    global _history_revision
+    conversation_history.clear()
+    r = get_redis()
+    if r is not None:
+        r.delete(_REDIS_HISTORY)
+    _history_revision += 1
+    clear_semantic_cache()
 
 # ============== PDF LOADING ==============
 def format_docs(docs):
     return "\n\n".join(doc.page_content for doc in docs)
 
-def load_pdf_with_pymupdf(file_path: str) -> List[Document]:
-    """Load PDF using PyMuPDF which handles fonts/encoding better"""
-    documents = []
-    filename = os.path.basename(file_path)
-    
+def _extract_page_range(file_path: str, start: int, stop: int) -> List[Tuple[int, str]]:
+    """Extract text for pages [start, stop) using a private document handle"""
+    # fitz.Document is not thread-safe, so every worker opens its own
+    doc = fitz.open(file_path)
     try:
-        doc = fitz.open(file_path)
-        for page_num in range(len(doc)):
-            page = doc[page_num]
-            text = page.get_text()
-            
-            if text.strip():  # Only add non-empty pages
-                documents.append(Document(
-                    page_content=text,
-                    metadata={
-                        "page": page_num,
-                        "source": file_path,
-                        "filename": filename,
-                        "upload_time": datetime.now().isoformat()
-                    }
-                ))
+        return [
+            (page_num, doc[page_num].get_text("text", sort=False, flags=PDF_TEXT_FLAGS))
+            for page_num in range(start, stop)
+        ]
+    finally:
         doc.close()
-        print(f"Loaded {len(documents)} pages from {filename}")
+
+def _extract_ranges(file_path: str, page_count: int, executor: Optional[ThreadPoolExecutor]) -> Iterator[List[Tuple[int, str]]]:
+    """Yield extracted page ranges in page order, keeping at most 2 * PDF_EXTRACT_WORKERS in flight"""
+    starts = range(0, page_count, PDF_PAGES_PER_RANGE)
+    if executor is None:
+        for start in starts:
+            yield _extract_page_range(file_path, start, min(start + PDF_PAGES_PER_RANGE, page_count))
+        return
+    
+    pending: Deque[Future] = deque()
+    for start in starts:
+        pending.append(executor.submit(_extract_page_range, file_path, start, min(start + PDF_PAGES_PER_RANGE, page_count)))
+        if len(pending) >= 2 * PDF_EXTRACT_WORKERS:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def load_pdf_with_pymupdf(file_path: str, filename: Optional[str] = None) -> Iterator[Document]:
+    """Load PDF using PyMuPDF which handles fonts/encoding better, yielding one Document per page"""
+    filename = filename or os.path.basename(file_path)
+    upload_time = datetime.now().isoformat()  # One timestamp for the whole file
+    loaded = 0
+    
+    try:
+        with fitz.open(file_path) as doc:
+            page_count = len(doc)
+        
+        executor = None
+        if page_count >= PDF_PARALLEL_MIN_PAGES and PDF_EXTRACT_WORKERS > 1:
+            # PyMuPDF releases the GIL in get_text(), so threads scale across pages
+            executor = ThreadPoolExecutor(max_workers=PDF_EXTRACT_WORKERS)
+        
+        try:
+            for page_range in _extract_ranges(file_path, page_count, executor):
+                for page_num, text in page_range:
+                    if text.strip():  # Only add non-empty pages
+                        loaded += 1
+                        yield Document(
+                            page_content=text,
+                            metadata={
+                                "page": page_num,
+                                "source": file_path,
+                                "filename": filename,
+                                "upload_time": upload_time
+                            }
+                        )
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+        print(f"Loaded {loaded} pages from {filename}")
     except Exception as e:
         print(f"Error loading PDF: {e}")
-    
-    return documents
+
+# ============== EMBEDDINGS ==============
+class SentenceTransformerEmbeddings(Embeddings):
+    """LangChain adapter that encodes straight through SentenceTransformer in large batches (GPU/FP16 when available)"""
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL, device: Optional[str] = None, batch_size: int = EMBEDDING_BATCH_SIZE):
+        import torch
+        from sentence_transformers import SentenceTransformer
+        
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.model = SentenceTransformer(model_name, device=device)
+        if device.startswith("cuda"):
+            # FP16 runs the matmuls on tensor cores; normalized outputs are unaffected in practice
+            self.model.half()
+        self.batch_size = batch_size
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = self.model.encode(
+            texts,
+            batch_size=self.batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False
+        )
+        return vectors.tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+class OnnxEmbeddings(Embeddings):
+    """
+    Quantized MiniLM served through ONNX Runtime on CPU.
+    Expects a directory produced by:
+        optimum-cli export onnx --task feature-extraction --optimize O3 \
+            sentence-transformers/all-MiniLM-L6-v2 <dir>
+    followed by onnxruntime.quantization.quantize_dynamic(..., weight_type=QuantType.QInt8)
+    into <dir>/model_quantized.onnx.
+    """
+
+    def __init__(self, model_dir: str, batch_size: int = EMBEDDING_BATCH_SIZE, max_length: int = 256):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        model_file = os.path.join(model_dir, "model_quantized.onnx")
+        if not os.path.exists(model_file):
+            model_file = os.path.join(model_dir, "model.onnx")
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = os.cpu_count() or 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.session = ort.InferenceSession(model_file, options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.batch_size = batch_size
+        self.max_length = max_length
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            encoded = self.tokenizer(
+                texts[start:start + self.batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_length,
+                return_tensors="np"
+            )
+            feeds = {k: v.astype(np.int64) for k, v in encoded.items() if k in self.input_names}
+            hidden = self.session.run(None, feeds)[0]
+            # Mean pooling over real tokens, then L2-normalize (matches sentence-transformers)
+            mask = encoded["attention_mask"][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            vectors.extend(pooled.tolist())
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+@lru_cache(maxsize=1)
+def get_embeddings() -> Embeddings:
+    """Load the embedding model once and share it across ingestion and retrieval"""
+    if EMBEDDING_ONNX_DIR:
+        try:
+            embeddings = OnnxEmbeddings(EMBEDDING_ONNX_DIR)
+            print(f"Using ONNX embeddings from: {EMBEDDING_ONNX_DIR}")
+            return embeddings
+        except Exception as e:
+            print(f"Failed to load ONNX embeddings, falling back to SentenceTransformer: {e}")
+    return SentenceTransformerEmbeddings()
+
+# ============== SEMANTIC CACHE ==============
+# Ring buffer of cached answers. Question vectors live in one preallocated,
+# L2-normalized matrix so a lookup is a single matrix-vector product.
+# Like the exact cache, entries ignore follow-up history: a question repeated
+# within a conversation gets its first answer until the conversation is cleared.
+_semantic_cache_lock = threading.Lock()
+_semantic_cache_mat: Optional[np.ndarray] = None  # (SEMANTIC_CACHE_SIZE, dim) float32, allocated on first store
+_semantic_cache_created = np.zeros(SEMANTIC_CACHE_SIZE)  # Store time per slot (0 = empty)
+_semantic_cache_filter = np.zeros(SEMANTIC_CACHE_SIZE, dtype=np.int64)  # hash(filter_filename) per slot
+_semantic_cache_entries: List[Optional[Tuple[str, List[str], Dict]]] = [None] * SEMANTIC_CACHE_SIZE
+_semantic_cache_next = 0  # Next slot to overwrite
+
+def _unit_vector(embedding: List[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+def semantic_cache_lookup(query_embedding: List[float], filter_filename: Optional[str]) -> Optional[Tuple[str, List[str], Dict]]:
+    """Return a cached (answer, citations, metadata) for a near-duplicate question, if any"""
+    with _semantic_cache_lock:
+        if _semantic_cache_mat is None:
+            return None
+        
+        # Cosine similarity against every slot, masking expired/empty slots and other filters
+        sims = _semantic_cache_mat @ _unit_vector(query_embedding)
+        valid = (_semantic_cache_created > time.time() - SEMANTIC_CACHE_TTL) & (_semantic_cache_filter == hash(filter_filename))
+        sims = np.where(valid, sims, -1.0)
+        best = int(sims.argmax())
+        if sims[best] < SEMANTIC_CACHE_THRESHOLD:
+            return None
+        return _semantic_cache_entries[best]
+
+def semantic_cache_store(query_embedding: List[float], filter_filename: Optional[str], answer: str, citations: List[str], metadata: Dict):
+    """Remember an answer for later near-duplicate questions (overwrites the oldest slot)"""
+    global _semantic_cache_mat, _semantic_cache_next
+    vector = _unit_vector(query_embedding)
+    with _semantic_cache_lock:
+        if _semantic_cache_mat is None:
+            _semantic_cache_mat = np.zeros((SEMANTIC_CACHE_SIZE, vector.shape[0]), dtype=np.float32)
+        slot = _semantic_cache_next % SEMANTIC_CACHE_SIZE
+        _semantic_cache_mat[slot] = vector
+        _semantic_cache_created[slot] = time.time()
+        _semantic_cache_filter[slot] = hash(filter_filename)
+        _semantic_cache_entries[slot] = (answer, list(citations), dict(metadata))
+        _semantic_cache_next += 1
+
+def clear_semantic_cache():
+    """Drop all cached answers (the knowledge base or conversation changed)"""
+    global _cache_revision, _semantic_cache_next
+    with _semantic_cache_lock:
+        _semantic_cache_created[:] = 0
+        _semantic_cache_entries[:] = [None] * SEMANTIC_CACHE_SIZE
+        _semantic_cache_next = 0
+    _cache_revision += 1
 
 # ============== LLM INITIALIZATION ==============
 def init_ollama():
-    """Initialize Ollama LLM"""
+    """Initialize Ollama LLM (called once; the instance is shared by all requests)"""
     try:
+        import httpx
         from langchain_ollama import ChatOllama
         
         model_name = os.getenv("OLLAMA_MODEL", "llama3.2")
         base_url = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
         
+        # One pooled HTTP client for every call; keep_alive also keeps the model loaded in Ollama
         ollama_llm = ChatOllama(
             model=model_name,
             temperature=0,
-            base_url=base_url
+            base_url=base_url,
+            keep_alive=os.getenv("OLLAMA_KEEP_ALIVE", "30m"),
+            client_kwargs={
+                "limits": httpx.Limits(max_connections=20, max_keepalive_connections=20, keepalive_expiry=300),
+                "timeout": httpx.Timeout(120.0, connect=5.0)
+            }
         )
         
-        # Test connection
-        ollama_llm.invoke("test")
+        # Test connection: listing installed models is cheap and needs no generation
+        response = httpx.get(f"{base_url}/api/tags", timeout=2.0)
+        response.raise_for_status()
+        installed = [m.get("name", "") for m in response.json().get("models", [])]
+        if not any(name == model_name or name.startswith(f"{model_name}:") for name in installed):
+            raise RuntimeError(f"model '{model_name}' is not installed (run: ollama pull {model_name})")
         print(f"Ollama initialized successfully with model: {model_name}")
         return ollama_llm
     except Exception as e:
         print(f"Failed to initialize Ollama: {e}")
         return None
 
-# ============== INGESTION ==============
-def ingest_pdf(file_path: str) -> int:
-    """Ingest a single PDF file"""
-    global vector_store, retriever, llm, uploaded_documents
+# ============== STARTUP WARMUP ==============
+def warm_up():
+    """Load models and connections up front so the first request doesn't pay for them"""
+    global vector_store, retriever, llm
+    
+    # 1. Embedding model weights (first encode also initializes the runtime)
+    embeddings = get_embeddings()
+    embeddings.embed_query("warmup")
+    print("Embedding model warmed up")
     
-    filename = os.path.basename(file_path)
+    # 2. LLM connection
+    if llm is None:
+        llm = init_ollama()
     
-    # 1. Load PDF using PyMuPDF
-    documents = load_pdf_with_pymupdf(file_path)
+    # 3. Reopen a persisted knowledge base and rebuild the file registry from it
+    persist_directory = _persist_directory()
+    if persist_directory and vector_store is None and os.path.exists(persist_directory):
+        with _ingest_lock:
+            store = _create_vector_store(embeddings)
+            metadatas = _collection(store).get(include=["metadatas"])["metadatas"]
+            if metadatas:
+                for metadata in metadatas:
+                    filename = (metadata or {}).get("filename", "Unknown")
+                    uploaded_documents[filename] = uploaded_documents.get(filename, 0) + 1
+                vector_store = store
+                retriever = _build_retriever(vector_store)
+                print(f"Reopened knowledge base with {len(uploaded_documents)} files")
+
+# ============== INGESTION ==============
+def _persist_directory() -> Optional[str]:
+    """Where the active vector backend persists, or None when it is in memory only"""
+    if VECTOR_BACKEND == "faiss":
+        return FAISS_PERSIST_DIRECTORY if FAISS_PERSIST else None
+    return CHROMA_PERSIST_DIRECTORY if CHROMA_PERSIST else None
+
+def _create_vector_store(embeddings: Embeddings):
+    """Create the vector store for VECTOR_BACKEND - in memory unless persistence is enabled"""
+    if VECTOR_BACKEND == "faiss":
+        return FaissStore(_persist_directory())
     
-    if not documents:
-        raise ValueError("Could not extract text from PDF. The file may be empty or corrupted.")
+    if CHROMA_PERSIST:
+        return Chroma(
+            embedding_function=embeddings,
+            persist_directory=CHROMA_PERSIST_DIRECTORY,
+            collection_metadata=CHROMA_COLLECTION_METADATA
+        )
     
-    # 2. Split Text
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=CHUNK_SIZE, 
-        chunk_overlap=CHUNK_OVERLAP
+    # The knowledge base is reset via DELETE /files anyway, so skip SQLite writes
+    import chromadb
+    return Chroma(
+        client=chromadb.EphemeralClient(),
+        embedding_function=embeddings,
+        collection_metadata=CHROMA_COLLECTION_METADATA
     )
-    texts = text_splitter.split_documents(documents)
+
+def _collection(store):
+    """The collection-level API (get/add/query) of either backend"""
+    return store if isinstance(store, FaissStore) else store._collection
+
+def _relevance_fn(store):
+    """Distance -> relevance score conversion for either backend"""
+    return store.relevance_score if isinstance(store, FaissStore) else store._select_relevance_score_fn()
+
+def _build_retriever(store):
+    """MMR retriever over a Chroma store, using the same settings as retrieve_with_scores"""
+    if isinstance(store, FaissStore):
+        return None  # Retrieval always goes through retrieve_with_scores
+    return store.as_retriever(
+        search_type="mmr",
+        search_kwargs={"k": RETRIEVAL_K, "fetch_k": RETRIEVAL_FETCH_K, "lambda_mult": MMR_LAMBDA}
+    )
+
+def chunk_id(chunk: Document) -> str:
+    """Stable id for a chunk: same file + same text always hashes to the same id"""
+    key = f"{chunk.metadata.get('filename', '')}\x00{chunk.page_content}"
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+
+def _embed_concurrently(embeddings: Embeddings, texts: List[str]) -> List[List[float]]:
+    """Embed texts in contiguous shards on EMBED_WORKERS threads, keeping input order"""
+    if EMBED_WORKERS <= 1 or len(texts) <= EMBEDDING_BATCH_SIZE:
+        return embeddings.embed_documents(texts)
     
-    print(f"Split {filename} into {len(texts)} chunks")
+    # Whole encode batches per shard; tokenization of one shard overlaps the
+    # forward pass of another since torch/ONNX Runtime release the GIL
+    step = -(-len(texts) // EMBED_WORKERS)
+    step = -(-step // EMBEDDING_BATCH_SIZE) * EMBEDDING_BATCH_SIZE
+    with ThreadPoolExecutor(max_workers=EMBED_WORKERS) as executor:
+        shards = executor.map(embeddings.embed_documents, [texts[i:i + step] for i in range(0, len(texts), step)])
+        return [vector for shard in shards for vector in shard]
+
+def _check_generation(generation: int):
+    """Abort an ingestion that started before the knowledge base was cleared"""
+    if generation != _kb_generation:
+        raise RuntimeError("Knowledge base was cleared while this PDF was being processed")
+
+def _store_chunks(chunks: List[Document], embeddings: Embeddings, generation: int):
+    """Embed a batch of chunks and write them to the vector store, skipping ones already stored"""
+    global vector_store
     
-    # Debug: Print first chunk
-    if texts:
-        print(f"Sample text: {texts[0].page_content[:200]}...")
+    _check_generation(generation)
+    # Content-hash ids dedupe repeated chunks within the batch and across re-uploads
+    by_id = {chunk_id(c): c for c in chunks}
+    if vector_store is not None:
+        existing = _collection(vector_store).get(ids=list(by_id), include=[])["ids"]
+        for stored_id in existing:
+            by_id.pop(stored_id, None)
+    if not by_id:
+        return
     
-    # 3. Embeddings
-    embeddings = HuggingFaceEmbeddings(
-        model_name="all-MiniLM-L6-v2",
-        model_kwargs={'device': 'cpu'}
-    )
+    # Encode the whole batch in one pass (shared model), outside the lock
+    ids = list(by_id)
+    chunk_texts = [c.page_content for c in by_id.values()]
+    vectors = _embed_concurrently(embeddings, chunk_texts)
     
-    # 4. Add to or create vector store
-    persist_directory = "./chroma_db"
+    with _ingest_lock:
+        _check_generation(generation)
+        if vector_store is None:
+            # Create new vector store
+            vector_store = _create_vector_store(embeddings)
+        
+        # Write precomputed vectors directly so Chroma doesn't re-embed,
+        # in moderate batches to amortize per-call overhead without huge transactions
+        metadatas = [c.metadata for c in by_id.values()]
+        for i in range(0, len(ids), CHROMA_ADD_BATCH_SIZE):
+            _collection(vector_store).add(
+                ids=ids[i:i + CHROMA_ADD_BATCH_SIZE],
+                embeddings=vectors[i:i + CHROMA_ADD_BATCH_SIZE],
+                documents=chunk_texts[i:i + CHROMA_ADD_BATCH_SIZE],
+                metadatas=metadatas[i:i + CHROMA_ADD_BATCH_SIZE]
+            )
+
+# Shared by all uploads (the splitter is stateless); lengths are measured in tokens
+_SPLITTER = RecursiveCharacterTextSplitter(
+    chunk_size=CHUNK_SIZE,
+    chunk_overlap=CHUNK_OVERLAP,
+    length_function=token_length
+)
+
+def ingest_pdf(file_path: str, filename: Optional[str] = None) -> int:
+    """
+    Ingest a single PDF file, streaming pages through split -> embed -> store.
+    `filename` is the name shown in citations and /files (default: the file's basename).
+    """
+    global retriever, llm
     
-    if vector_store is None:
-        # Create new vector store
-        vector_store = Chroma.from_documents(
-            documents=texts,
-            embedding=embeddings,
-            persist_directory=persist_directory
-        )
-    else:
-        # Add to existing vector store
-        vector_store.add_documents(texts)
+    filename = filename or os.path.basename(file_path)
+    generation = _kb_generation
     
-    # Setup retriever
-    retriever = vector_store.as_retriever(search_kwargs={"k": 5})
+    embeddings = get_embeddings()
     
-    # Initialize LLM if not done
-    if llm is None:
-        llm = init_ollama()
+    # 1. Load pages lazily, 2. split each page as it arrives,
+    # 3-4. embed and store in fixed-size batches to bound memory
+    total_chunks = 0
+    batch: List[Document] = []
+    for page in load_pdf_with_pymupdf(file_path, filename):
+        batch.extend(_SPLITTER.split_documents([page]))
+        if len(batch) >= INGEST_BATCH_SIZE:
+            if total_chunks == 0:
+                print(f"Sample text: {batch[0].page_content[:200]}...")
+            _store_chunks(batch, embeddings, generation)
+            total_chunks += len(batch)
+            batch = []
+    if batch:
+        if total_chunks == 0:
+            print(f"Sample text: {batch[0].page_content[:200]}...")
+        _store_chunks(batch, embeddings, generation)
+        total_chunks += len(batch)
     
-    # Track uploaded file
-    uploaded_documents[filename] = len(texts)
+    if total_chunks == 0:
+        raise ValueError("Could not extract text from PDF. The file may be empty or corrupted.")
     
-    return len(texts)
+    print(f"Split {filename} into {total_chunks} chunks")
+    
+    with _ingest_lock:
+        _check_generation(generation)
+        
+        # Setup retriever
+        retriever = _build_retriever(vector_store)
+        
+        # FAISS writes its index once per file rather than per batch
+        if isinstance(vector_store, FaissStore):
+            vector_store.persist()
+        
+        # Initialize LLM if not done
+        if llm is None:
+            llm = init_ollama()
+        
+        # Track uploaded file
+        uploaded_documents[filename] = total_chunks
+    
+    # New content can change answers to earlier questions
+    clear_semantic_cache()
+    
+    return total_chunks
 
 def get_uploaded_files() -> Dict[str, int]:
     """Get list of uploaded files with chunk counts"""
@@ -242,40 +684,62 @@ def get_uploaded_files() -> Dict[str, int]:
 
 def clear_knowledge_base():
     """Clear all documents and reset - properly clears ChromaDB"""
-    global vector_store, retriever, uploaded_documents, conversation_history, llm
+    global vector_store, retriever, uploaded_documents, _kb_generation
     
     import shutil
-    persist_directory = "./chroma_db"
+    persist_directory = _persist_directory()
     
-    # First, try to delete the collection properly if vector_store exists
-    if vector_store is not None:
-        try:
-            # Try to delete the collection
-            vector_store.delete_collection()
-            print("✅ ChromaDB collection deleted")
-        except Exception as e:
-            print(f"Note: Could not delete collection: {e}")
-    
-    # Then remove the persist directory
-    if os.path.exists(persist_directory):
-        try:
-            shutil.rmtree(persist_directory)
-            print(f"✅ Removed {persist_directory}")
-        except Exception as e:
-            print(f"Warning: Could not remove {persist_directory}: {e}")
+    with _ingest_lock:
+        # Running ingestions see the new generation and stop before writing again
+        _kb_generation += 1
+        
+        # First, try to delete the collection properly if vector_store exists
+        if vector_store is not None:
+            try:
+                # Try to delete the collection
+                vector_store.delete_collection()
+                print("✅ Vector store collection deleted")
+            except Exception as e:
+                print(f"Note: Could not delete collection: {e}")
+        
+        # Then remove the persist directory. Renaming is instant and frees the path
+        # for new uploads; the (possibly large) delete runs in the background.
+        if persist_directory and os.path.exists(persist_directory):
+            try:
+                trash_directory = f"{persist_directory}.deleting-{int(time.time() * 1000)}"
+                os.rename(persist_directory, trash_directory)
+                threading.Thread(
+                    target=shutil.rmtree,
+                    args=(trash_directory,),
+                    kwargs={"ignore_errors": True},
+                    daemon=True
+                ).start()
+                print(f"✅ Removing {persist_directory} in the background")
+                if VECTOR_BACKEND != "faiss":
+                    # chromadb caches one client system per path, still holding the sqlite
+                    # handle of the renamed directory; drop it so the next upload starts fresh
+                    from chromadb.api.client import SharedSystemClient
+                    SharedSystemClient.clear_system_cache()
+            except Exception as e:
+                print(f"Warning: Could not remove {persist_directory}: {e}")
+        
+        # Reset all state except LLM (keep it initialized)
+        vector_store = None
+        retriever = None
+        uploaded_documents = {}
     
-    # Reset all state except LLM (keep it initialized)
-    vector_store = None
-    retriever = None
-    uploaded_documents = {}
-    conversation_history = []
+    clear_conversation()
     
     print("✅ Knowledge base cleared completely")
     return True
 
 # ============== RETRIEVAL WITH CONFIDENCE ==============
-def retrieve_with_scores(question: str, filter_filename: Optional[str] = None) -> Tuple[List[Document], List[float]]:
-    """Retrieve documents with relevance scores"""
+def retrieve_with_scores(
+    question: str,
+    filter_filename: Optional[str] = None,
+    query_embedding: Optional[List[float]] = None
+) -> Tuple[List[Document], List[float]]:
+    """Retrieve documents with relevance scores (pass query_embedding to skip re-embedding)"""
     global vector_store
     
     if vector_store is None:
@@ -286,75 +750,100 @@ def retrieve_with_scores(question: str, filter_filename: Optional[str] = None) -
     if filter_filename:
         where_filter = {"filename": filter_filename}
     
-    # Get docs with scores
-    results = vector_store.similarity_search_with_relevance_scores(
-        question,
-        k=5,
-        filter=where_filter
+    # Fetch a wider candidate set, then pick a relevant-but-diverse subset with MMR
+    if query_embedding is None:
+        query_embedding = get_embeddings().embed_query(question)
+    results = _collection(vector_store).query(
+        query_embeddings=[query_embedding],
+        n_results=RETRIEVAL_FETCH_K,
+        where=where_filter,
+        include=["documents", "metadatas", "distances", "embeddings"]
     )
+    candidates = results["documents"][0]
+    if not candidates:
+        return [], []
     
-    docs = [doc for doc, score in results]
-    scores = [score for doc, score in results]
+    selected = maximal_marginal_relevance(
+        np.array(query_embedding, dtype=np.float32),
+        results["embeddings"][0],
+        k=min(RETRIEVAL_K, len(candidates)),
+        lambda_mult=MMR_LAMBDA
+    )
+    
+    to_score = _relevance_fn(vector_store)
+    docs = [Document(page_content=candidates[i], metadata=results["metadatas"][0][i] or {}) for i in selected]
+    scores = [to_score(results["distances"][0][i]) for i in selected]
     
     return docs, scores
 
 # ============== ANSWER GENERATION ==============
-def get_answer(
-    question: str, 
-    filter_filename: Optional[str] = None,
-    use_history: bool = True
-) -> Tuple[str, List[str], Dict]:
+def _retrieve_context(
+    question: str,
+    filter_filename: Optional[str],
+    query_embedding: List[float]
+) -> Tuple[List[str], str, List[float]]:
+    """Retrieve chunks for a question and return (citations, context, scores)"""
+    docs, scores = retrieve_with_scores(question, filter_filename, query_embedding)
+    
+    # Build citations (retrieve_with_scores returns one score per document)
+    citations = [
+        f"[{doc.metadata.get('filename', 'Unknown')}] Page {doc.metadata.get('page', 'Unknown')} "
+        f"(relevance: {score:.2f}): {doc.page_content[:150].replace(chr(10), ' ')}..."
+        for doc, score in zip(docs, scores)
+    ]
+    
+    # Order context by document position, not relevance, so the same chunks
+    # always render the same prompt prefix (better LLM prefix-cache reuse)
+    ordered = sorted(docs, key=lambda d: (str(d.metadata.get("filename", "")), d.metadata.get("page", 0)))
+    return citations, format_docs(ordered), scores
+
+# Exact-question cache: {(question, filter_filename, use_history, revision): (answer, citations, metadata)},
+# kept in LRU order. The revision changes whenever the knowledge base or
+# conversation is reset; follow-up turns do not change the key, so a repeated
+# question within one conversation is answered without regard to the turns in between.
+_exact_cache: "OrderedDict[tuple, Tuple[str, Tuple[str, ...], Dict]]" = OrderedDict()
+_exact_cache_lock = threading.Lock()
+
+def exact_cache_lookup(key: tuple) -> Optional[Tuple[str, Tuple[str, ...], Dict]]:
+    """Return the cached (answer, citations, metadata) for an exact repeat, if any"""
+    with _exact_cache_lock:
+        cached = _exact_cache.get(key)
+        if cached is not None:
+            _exact_cache.move_to_end(key)
+        return cached
+
+def exact_cache_store(key: tuple, answer: str, citations: List[str], metadata: Dict):
+    """Remember an answer for exact repeats (drops the least recently used past EXACT_CACHE_SIZE)"""
+    with _exact_cache_lock:
+        _exact_cache[key] = (answer, tuple(citations), dict(metadata))
+        if len(_exact_cache) > EXACT_CACHE_SIZE:
+            _exact_cache.popitem(last=False)
+
+def _answer_from_documents(
+    question: str,
+    filter_filename: Optional[str],
+    use_history: bool
+) -> Tuple[str, List[str], Dict, bool]:
     """
-    Get answer with citations and metadata.
-    Returns: (answer, citations, metadata)
+    Retrieve and generate an answer from the knowledge base.
+    Returns (answer, citations, metadata, cacheable); degraded answers are not cacheable.
     """
-    global retriever, llm
-    
     start_time = time.time()
     
-    # Handle greetings and casual conversation FIRST (before checking for PDFs)
-    if is_greeting_or_casual(question):
-        friendly_response = get_friendly_response(question)
-        add_to_history("user", question)
-        add_to_history("assistant", friendly_response)
-        return friendly_response, [], {
-            "confidence": 1.0,
-            "tokens_input": count_tokens(question),
-            "tokens_output": count_tokens(friendly_response),
-            "latency_ms": int((time.time() - start_time) * 1000),
-            "is_casual": True
-        }
-    
-    if vector_store is None:
-        return "👋 Please upload a PDF first! Click the upload button to add a document, then ask me questions about it.", [], {
-            "confidence": 0,
-            "tokens_used": 0,
-            "latency_ms": 0
-        }
+    # Serve near-duplicate questions from the semantic cache
+    query_embedding = get_embeddings().embed_query(question)
+    cached = semantic_cache_lookup(query_embedding, filter_filename)
+    if cached is not None:
+        answer, citations, metadata = cached
+        return answer, citations, {**metadata, "cached": True}, True
     
-    # Add question to history
-    add_to_history("user", question)
-    
-    # Get relevant documents with scores
-    docs, scores = retrieve_with_scores(question, filter_filename)
-    
-    # Check confidence threshold
+    citations, context, scores = _retrieve_context(question, filter_filename, query_embedding)
     avg_score = sum(scores) / len(scores) if scores else 0
     max_score = max(scores) if scores else 0
     
-    # Build citations
-    citations = []
-    for i, doc in enumerate(docs):
-        page = doc.metadata.get("page", "Unknown")
-        filename = doc.metadata.get("filename", "Unknown")
-        score = scores[i] if i < len(scores) else 0
-        content_snippet = doc.page_content[:150].replace("\n", " ") + "..."
-        citations.append(f"[{filename}] Page {page} (relevance: {score:.2f}): {content_snippet}")
-    
-    context = format_docs(docs)
-    
-    # Count tokens
-    input_tokens = count_tokens(context + question)
+    # Count tokens - separately, so no prompt-sized concatenation is built and
+    # the (often repeated) context hits the token-count cache on its own
+    input_tokens = count_tokens(context) + count_tokens(question)
     
     # DISABLED: Confidence threshold check removed - always try to answer
     # if max_score < CONFIDENCE_THRESHOLD:
@@ -363,7 +852,6 @@ def get_answer(
     if not llm:
         # Fallback mode
         answer = f"Based on the document, here's the relevant content:\n\n{context[:1500]}..."
-        add_to_history("assistant", answer)
         
         return answer, citations, {
             "confidence": max_score,
@@ -372,53 +860,23 @@ def get_answer(
             "tokens_output": count_tokens(answer),
             "latency_ms": int((time.time() - start_time) * 1000),
             "llm_used": False
-        }
+        }, True
     
     # Build prompt with conversation history
     conversation_context = get_conversation_context() if use_history else ""
     
     try:
-        from langchain_core.prompts import ChatPromptTemplate
-        from langchain_core.output_parsers import StrOutputParser
-        from langchain_core.runnables import RunnablePassthrough
-        
-        prompt_template = """You are a helpful assistant answering questions about documents.
-
-{conversation_context}
-
-Based ONLY on the following context from the documents, answer the question.
-Be concise and specific. Give a direct answer in 1-3 sentences.
-If the answer is not in the context, say "I cannot find this specific information in the uploaded documents."
-
-Context from documents:
-{context}
-
-Question: {question}
-
-Answer:"""
-        
-        prompt = ChatPromptTemplate.from_template(prompt_template)
-        
-        chain = (
-            {
-                "context": lambda x: context,
-                "question": RunnablePassthrough(),
-                "conversation_context": lambda x: conversation_context
-            }
-            | prompt
-            | llm
-            | StrOutputParser()
+        messages = _PROMPT.format_messages(
+            context=context,
+            question=question,
+            conversation_context=conversation_context
         )
-        
-        answer = chain.invoke(question)
-        
-        # Add to history
-        add_to_history("assistant", answer)
+        answer = llm.invoke(messages).content
         
         output_tokens = count_tokens(answer)
         latency = int((time.time() - start_time) * 1000)
         
-        return answer, citations, {
+        metadata = {
             "confidence": max_score,
             "avg_relevance": avg_score,
             "tokens_input": input_tokens,
@@ -428,14 +886,154 @@ Answer:"""
             "llm_used": True,
             "model": os.getenv("OLLAMA_MODEL", "llama3.2")
         }
+        semantic_cache_store(query_embedding, filter_filename, answer, citations, metadata)
+        
+        return answer, citations, metadata, True
         
     except Exception as e:
         print(f"LLM Error: {e}")
         answer = f"Based on the document, here's the relevant content:\n\n{context[:1500]}..."
-        add_to_history("assistant", answer)
         
+        # Don't cache a degraded answer - the LLM may recover on the next call
         return answer, citations, {
             "confidence": max_score,
             "error": str(e),
             "latency_ms": int((time.time() - start_time) * 1000)
+        }, False
+
+def get_answer(
+    question: str, 
+    filter_filename: Optional[str] = None,
+    use_history: bool = True
+) -> Tuple[str, List[str], Dict]:
+    """
+    Get answer with citations and metadata.
+    Returns: (answer, citations, metadata)
+    """
+    start_time = time.time()
+    
+    # Handle greetings and casual conversation FIRST (before checking for PDFs)
+    if is_greeting_or_casual(question):
+        friendly_response = get_friendly_response(question)
+        add_to_history("user", question)
+        add_to_history("assistant", friendly_response)
+        return friendly_response, [], {
+            "confidence": 1.0,
+            "tokens_input": count_tokens(question),
+            "tokens_output": count_tokens(friendly_response),
+            "latency_ms": int((time.time() - start_time) * 1000),
+            "is_casual": True
+        }
+    
+    if vector_store is None:
+        return "👋 Please upload a PDF first! Click the upload button to add a document, then ask me questions about it.", [], {
+            "confidence": 0,
+            "tokens_used": 0,
+            "latency_ms": 0
         }
+    
+    # Add question to history
+    add_to_history("user", question)
+    
+    # Exact repeats of a question are answered from the LRU cache
+    cache_key = (question, filter_filename, use_history, _cache_revision)
+    cached = exact_cache_lookup(cache_key)
+    if cached is not None:
+        answer, citations, metadata = cached
+        metadata = {**metadata, "cached": True}
+    else:
+        answer, citations, metadata, cacheable = _answer_from_documents(question, filter_filename, use_history)
+        if cacheable:
+            exact_cache_store(cache_key, answer, citations, metadata)
+    
+    add_to_history("assistant", answer)
+    
+    metadata = {**metadata, "latency_ms": int((time.time() - start_time) * 1000)}
+    return answer, list(citations), metadata
+
+def stream_answer(
+    question: str,
+    filter_filename: Optional[str] = None,
+    use_history: bool = True
+) -> Iterator[Dict]:
+    """
+    Stream an answer as it is generated.
+    Yields {"token": str} events, then one final
+    {"done": True, "answer": str, "citations": [...], "metadata": {...}} event.
+    """
+    start_time = time.time()
+    
+    # Greetings, the empty knowledge base and LLM-less fallback have nothing to stream
+    if is_greeting_or_casual(question) or vector_store is None or not llm:
+        answer, citations, metadata = get_answer(question, filter_filename, use_history)
+        yield {"token": answer}
+        yield {"done": True, "answer": answer, "citations": citations, "metadata": metadata}
+        return
+    
+    add_to_history("user", question)
+    
+    query_embedding = get_embeddings().embed_query(question)
+    cached = semantic_cache_lookup(query_embedding, filter_filename)
+    if cached is not None:
+        answer, citations, metadata = cached
+        add_to_history("assistant", answer)
+        yield {"token": answer}
+        yield {"done": True, "answer": answer, "citations": citations, "metadata": {
+            **metadata,
+            "latency_ms": int((time.time() - start_time) * 1000),
+            "cached": True
+        }}
+        return
+    
+    citations, context, scores = _retrieve_context(question, filter_filename, query_embedding)
+    max_score = max(scores) if scores else 0
+    input_tokens = count_tokens(context) + count_tokens(question)
+    conversation_context = get_conversation_context() if use_history else ""
+    
+    messages = _PROMPT.format_messages(
+        context=context,
+        question=question,
+        conversation_context=conversation_context
+    )
+    
+    parts = []
+    first_token_ms = None
+    answer = None
+    error = None
+    try:
+        for chunk in llm.stream(messages):
+            if chunk.content:
+                if first_token_ms is None:
+                    first_token_ms = int((time.time() - start_time) * 1000)
+                parts.append(chunk.content)
+                yield {"token": chunk.content}
+        answer = "".join(parts)
+    except Exception as e:
+        print(f"LLM Error: {e}")
+        error = str(e)
+        answer = "".join(parts) or f"Based on the document, here's the relevant content:\n\n{context[:1500]}..."
+        if not parts:
+            yield {"token": answer}
+    finally:
+        # Also runs when the client disconnects mid-stream (the generator is closed
+        # at a yield), so the user turn above always gets its (partial) reply
+        add_to_history("assistant", answer if answer is not None else "".join(parts))
+    
+    output_tokens = count_tokens(answer)
+    metadata = {
+        "confidence": max_score,
+        "avg_relevance": sum(scores) / len(scores) if scores else 0,
+        "tokens_input": input_tokens,
+        "tokens_output": output_tokens,
+        "tokens_total": input_tokens + output_tokens,
+        "latency_ms": int((time.time() - start_time) * 1000),
+        "first_token_ms": first_token_ms,
+        "llm_used": error is None,
+        "model": os.getenv("OLLAMA_MODEL", "llama3.2")
+    }
+    if error is not None:
+        metadata["error"] = error
+    else:
+        semantic_cache_store(query_embedding, filter_filename, answer, citations, metadata)
+    
+    yield {"done": True, "answer": answer, "citations": citations, "metadata": metadata}
@@ -0,0 +1,40 @@
+"""
+Shared State Module
+Optional Redis connection for state that must be shared across API workers.
+Set REDIS_URL to enable it; without it each module keeps its state in memory.
+"""
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    import redis
+
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_RETRY_SECONDS = 10  # After a failed connect, wait this long before trying again
+
+_client: Optional["redis.Redis"] = None  # Only a connected client is kept
+_next_attempt = 0.0  # time.monotonic() before which no reconnect is tried
+_connect_lock = threading.Lock()
+
+def get_redis() -> Optional["redis.Redis"]:
+    """Return a pooled Redis client, or None when Redis is not configured/reachable"""
+    global _client, _next_attempt
+    if not REDIS_URL or _client is not None:
+        return _client
+    with _connect_lock:
+        if _client is not None or time.monotonic() < _next_attempt:
+            return _client
+        try:
+            import redis
+
+            client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+            client.ping()
+            print(f"Using Redis for shared state: {REDIS_URL}")
+            _client = client
+        except Exception as e:
+            # Not cached: retried after REDIS_RETRY_SECONDS so one blip doesn't pin this worker to memory
+            _next_attempt = time.monotonic() + REDIS_RETRY_SECONDS
+            print(f"Failed to connect to Redis, keeping state in memory for now: {e}")
+        return _client
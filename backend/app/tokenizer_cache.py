@@ -0,0 +1,64 @@
+"""
+Tokenizer Cache Module
+Memoized token counting - repeated prompts and answers skip re-tokenization
+"""
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import tiktoken
+
+L0_MAX_ENTRIES = 4096  # Token counts remembered before the least recently used is dropped
+
+# L0 cache: {(model, hash(text)): token_count}, kept in LRU order
+_l0: "OrderedDict[tuple, int]" = OrderedDict()
+_l0_lock = threading.Lock()
+_unavailable = set()  # Models whose encoding failed to load (e.g. offline without tiktoken's cache)
+
+@lru_cache(maxsize=4)
+def _get_encoding(model: str):
+    """Resolve and load a model's encoding once"""
+    return tiktoken.encoding_for_model(model)
+
+def _load_encoding(model: str):
+    """The model's encoding, or None once it has failed to load (no retry per call)"""
+    if model in _unavailable:
+        return None
+    try:
+        return _get_encoding(model)
+    except Exception as e:
+        _unavailable.add(model)
+        print(f"Tokenizer for {model} unavailable, estimating ~4 chars per token: {e}")
+        return None
+
+def count_tokens(text: str, model: str = "gpt-3.5-turbo") -> int:
+    """Count tokens with the model's encoding, answering repeats from the L0 cache"""
+    key = (model, hash(text))
+    with _l0_lock:
+        cached = _l0.get(key)
+        if cached is not None:
+            _l0.move_to_end(key)
+            return cached
+
+    encoding = _load_encoding(model)
+    if encoding is None:
+        return len(text) // 4
+    count = len(encoding.encode(text))
+
+    with _l0_lock:
+        _l0[key] = count
+        if len(_l0) > L0_MAX_ENTRIES:
+            _l0.popitem(last=False)
+    return count
+
+def token_length(text: str, model: str = "gpt-3.5-turbo") -> int:
+    """Count tokens without touching the L0 cache (for one-off strings such as split candidates)"""
+    encoding = _load_encoding(model)
+    if encoding is None:
+        return len(text) // 4
+    return len(encoding.encode_ordinary(text))
+
+def clear_cache():
+    """Drop all cached token counts"""
+    with _l0_lock:
+        _l0.clear()
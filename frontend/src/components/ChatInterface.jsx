@@ -42,6 +42,17 @@ export function ChatInterface() {
         }
     };
 
+    // Poll a background ingestion job until it completes or fails
+    const waitForUploadJob = async (jobId) => {
+        while (true) {
+            const response = await axios.get(`${API_URL}/upload/${jobId}`);
+            if (response.data.status === 'completed' || response.data.status === 'failed') {
+                return response.data;
+            }
+            await new Promise(resolve => setTimeout(resolve, 1000));
+        }
+    };
+
     const handleFileUpload = async (e) => {
         const files = Array.from(e.target.files);
         if (files.length === 0) return;
@@ -62,9 +73,14 @@ export function ChatInterface() {
                     headers: { 'Content-Type': 'multipart/form-data' }
                 });
 
+                const job = await waitForUploadJob(response.data.job_id);
+                if (job.status === 'failed') {
+                    throw new Error(job.error || 'Processing failed');
+                }
+
                 setMessages(prev => [...prev, {
                     role: 'bot',
-                    content: `✅ Processed **${response.data.filename}** (${response.data.chunks} chunks). Total files: ${response.data.total_files}. Ask me anything!`
+                    content: `✅ Processed **${job.filename}** (${job.chunks} chunks). Total files: ${job.total_files}. Ask me anything!`
                 }]);
 
                 await fetchUploadedFiles();
@@ -72,7 +88,7 @@ export function ChatInterface() {
                 console.error('Upload failed:', error);
                 setMessages(prev => [...prev, {
                     role: 'bot',
-                    content: `❌ Failed to upload ${file.name}: ${error.response?.data?.detail || 'Unknown error'}`
+                    content: `❌ Failed to upload ${file.name}: ${error.response?.data?.detail || error.message || 'Unknown error'}`
                 }]);
             }
         }